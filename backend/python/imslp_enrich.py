@@ -1,65 +1,114 @@
 #!/usr/bin/env python3
 import json
+import re
 import sys
+import threading
 import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 try:
-    from imslp.client import ImslpClient
+    import mwclient
 except Exception as exc:
-    sys.stderr.write("Failed to import imslp client: " + str(exc) + "\n")
+    sys.stderr.write("Failed to import mwclient: " + str(exc) + "\n")
     sys.exit(2)
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 HEADERS = {'User-Agent': 'OurTextScores/1.0 (+https://ourtextscores.example)'}
 IMSLP_API_URL = 'https://imslp.org/api.php'
 
-def get_with_retry(url, params=None, timeout=15, tries=3, backoff=1.5):
-    import requests
-    delay = 1.0
-    last = None
-    for i in range(max(1, tries)):
-        try:
-            r = requests.get(url, params=params, headers=HEADERS, timeout=timeout)
-            return r
-        except Exception as e:
-            last = e
-            time.sleep(delay)
-            delay *= backoff
-    raise last if last else Exception('request failed')
+# One pooled session for every call to imslp.org so consecutive requests reuse
+# keep-alive connections instead of paying a TCP+TLS handshake each time.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=1.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False,
+    ),
+)
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
+
+_site = None
+_site_lock = threading.Lock()
+
+_CANONICAL_RE = re.compile(r'<link rel="canonical" href="https?://imslp.org/wiki/([^"]+)"')
+
 
+def get_site():
+    # Built lazily on the shared SESSION so mwclient's siteinfo probe and page
+    # lookups reuse the same keep-alive pool as our direct API calls.
+    global _site
+    with _site_lock:
+        if _site is None:
+            _site = mwclient.Site('imslp.org', path='/', pool=SESSION)
+    return _site
 
-def extract_title(target: str) -> str:
+
+def get_with_retry(url, params=None, timeout=15):
+    # Retries and backoff are handled by the urllib3 Retry mounted on SESSION.
+    return SESSION.get(url, params=params, timeout=timeout)
+
+
+def extract_title(target: str):
+    """Return (display_title, url_segment); url_segment is the already-encoded wiki path when known."""
     if target.startswith('http://imslp.org/wiki/') or target.startswith('https://imslp.org/wiki/'):
-        title = target.split('/wiki/', 1)[1]
-        return urllib.parse.unquote(title)
-    # Numeric pageid: first try MediaWiki API, then fall back to canonical link
+        segment = target.split('/wiki/', 1)[1]
+        return urllib.parse.unquote(segment), segment
+    # Numeric pageid: first try MediaWiki API (title, else fullurl), then fall back to canonical link
     if target.isdigit():
         try:
             r = get_with_retry(
                 IMSLP_API_URL,
                 params={'action': 'query', 'format': 'json', 'prop': 'info', 'pageids': target, 'inprop': 'url'},
-                timeout=15, tries=3
+                timeout=15
             )
             if r.ok:
                 data = r.json()
                 pages = data.get('query', {}).get('pages', {})
                 page = next(iter(pages.values())) if pages else None
-                if page and not page.get('missing') and page.get('title'):
-                    return urllib.parse.unquote(page['title'])
+                if page and ('missing' in page or 'invalid' in page):
+                    # Definitive miss; the curid page would not resolve either.
+                    return target, None
+                if page:
+                    fullurl = page.get('fullurl') or page.get('canonicalurl')
+                    segment = fullurl.split('/wiki/', 1)[1] if fullurl and '/wiki/' in fullurl else None
+                    # API titles are plain text (MediaWiki forbids %XX in titles); no unquote needed.
+                    if page.get('title'):
+                        return page['title'], segment
+                    if segment:
+                        return urllib.parse.unquote(segment).replace('_', ' '), segment
         except Exception:
             pass
         try:
-            import requests, re
-            r2 = requests.get('https://imslp.org/index.php', params={'curid': target}, timeout=15)
-            if r2.ok:
-                txt = r2.text
-                m = re.search(r'<link rel="canonical" href="https?://imslp.org/wiki/([^"]+)"', txt)
-                if m:
-                    slug = urllib.parse.unquote(m.group(1))
-                    return slug.replace('_', ' ')
+            # The canonical <link> sits in the document head; stop reading after 8KB.
+            with SESSION.get('https://imslp.org/index.php', params={'curid': target}, timeout=15, stream=True) as r2:
+                if r2.ok:
+                    head = bytearray()
+                    for chunk in r2.iter_content(chunk_size=2048):
+                        head.extend(chunk)
+                        m = _CANONICAL_RE.search(head.decode('utf-8', 'ignore'))
+                        if m:
+                            segment = m.group(1)
+                            return urllib.parse.unquote(segment).replace('_', ' '), segment
+                        if len(head) >= 8192:
+                            break
         except Exception:
             pass
-    return urllib.parse.unquote(target)
+    return urllib.parse.unquote(target), None
 
 
 def resolve_canonical_page(target: str):
@@ -75,9 +124,9 @@ def resolve_canonical_page(target: str):
         if target.isdigit():
             params['pageids'] = target
         else:
-            params['titles'] = extract_title(target)
+            params['titles'] = extract_title(target)[0]
 
-        r = get_with_retry(IMSLP_API_URL, params=params, timeout=15, tries=3)
+        r = get_with_retry(IMSLP_API_URL, params=params, timeout=15)
         if not r.ok:
             return None
         data = r.json()
@@ -85,13 +134,16 @@ def resolve_canonical_page(target: str):
         if not pages:
             return None
         page = next(iter(pages.values()))
-        if not page or page.get('missing'):
+        if not page:
             return None
+        if 'missing' in page or 'invalid' in page:
+            # Definitive answer from the API, as opposed to a transient failure.
+            return {'missing': True}
         title = page.get('title')
         if not title:
             return None
         return {
-            'title': urllib.parse.unquote(title),
+            'title': title,
             'page_id': page.get('pageid'),
             'url': page.get('fullurl') or page.get('canonicalurl'),
             'redirected': bool((data.get('query') or {}).get('redirects')),
@@ -100,25 +152,29 @@ def resolve_canonical_page(target: str):
         return None
 
 
+def fetch_imageinfo_batch(chunk):
+    r = get_with_retry(IMSLP_API_URL, params={
+        'action': 'query',
+        'format': 'json',
+        'prop': 'imageinfo',
+        'iiprop': 'url|size|sha1|mime|timestamp|user|comment',
+        'titles': '|'.join(chunk)
+    }, timeout=20)
+    if not r.ok:
+        return {}
+    return r.json().get('query', {}).get('pages', {})
+
+
 def fetch_imageinfo_by_titles(titles):
     by_title = {}
     if not titles:
         return by_title
 
-    for i in range(0, min(len(titles), 100), 50):
-        chunk = titles[i:i+50]
-        titles_param = '|'.join(chunk)
-        r = get_with_retry(IMSLP_API_URL, params={
-            'action': 'query',
-            'format': 'json',
-            'prop': 'imageinfo',
-            'iiprop': 'url|size|sha1|mime|timestamp|user|comment',
-            'titles': titles_param
-        }, timeout=20, tries=3)
-        if not r.ok:
-            continue
-        data = r.json()
-        pages = data.get('query', {}).get('pages', {})
+    chunks = [titles[i:i+50] for i in range(0, min(len(titles), 100), 50)]
+    # Batches are independent; fetch them concurrently over the pooled session.
+    with ThreadPoolExecutor(max_workers=len(chunks)) as ex:
+        results = list(ex.map(fetch_imageinfo_batch, chunks))
+    for pages in results:
         for p in pages.values():
             ti = p.get('title')
             ii = p.get('imageinfo') or []
@@ -128,6 +184,16 @@ def fetch_imageinfo_by_titles(titles):
     return by_title
 
 
+def _download_urls(url):
+    if not url:
+        return {'original': None, 'https': None, 'direct': None}
+    return {
+        'original': url,
+        'https': url.replace('http:', 'https:', 1),
+        'direct': url.replace('//imslp.org/', 'https://imslp.org/', 1) if url.startswith('//') else url
+    }
+
+
 def build_file_entry(title, info=None, name=None):
     info = info if isinstance(info, dict) else {}
     url = info.get('url')
@@ -140,60 +206,96 @@ def build_file_entry(title, info=None, name=None):
         'mime_type': info.get('mime'),
         'timestamp': info.get('timestamp'),
         'user': info.get('user'),
-        'download_urls': {
-            'original': url,
-            'https': (url.replace('http:', 'https:') if url else None),
-            'direct': (url.replace('//imslp.org/', 'https://imslp.org/') if url and isinstance(url, str) and url.startswith('//') else url)
-        }
+        'download_urls': _download_urls(url)
     }
 
 
-def fetch_files_via_pageid(page_id):
-    if page_id in (None, ''):
-        return []
-    r = get_with_retry(IMSLP_API_URL, params={
+def fetch_page_bundle(title, page_id=None):
+    """Fetch categories, image titles and recent revisions of a page in one API call."""
+    params = {
         'action': 'query',
         'format': 'json',
-        'prop': 'images',
-        'pageids': str(page_id),
-        'imlimit': 100
-    }, timeout=20, tries=3)
-    if not r.ok:
-        return []
+        'prop': 'categories|images|revisions',
+        'cllimit': 'max',
+        'imlimit': 100,
+        'rvprop': 'ids|user|timestamp|comment',
+        'rvlimit': 5
+    }
+    if page_id not in (None, ''):
+        params['pageids'] = str(page_id)
+    else:
+        params['titles'] = title
+        params['redirects'] = 1
+    r = get_with_retry(IMSLP_API_URL, params=params, timeout=20)
+    r.raise_for_status()
     data = r.json()
     pages = data.get('query', {}).get('pages', {})
     page = next(iter(pages.values())) if pages else None
-    if not page or page.get('missing'):
-        return []
-    titles = []
-    for img in page.get('images') or []:
-        t = img.get('title')
-        if t:
-            titles.append(t)
+    if not page or 'missing' in page or 'invalid' in page:
+        return {}
+    return page
+
+
+def build_files(titles):
     by_title = fetch_imageinfo_by_titles(titles)
-    files = []
-    for ti in titles:
-        files.append(build_file_entry(ti, by_title.get(ti), name=ti))
-    return files
+    return [build_file_entry(ti, by_title.get(ti), name=ti) for ti in titles]
 
 
-def main():
-    if len(sys.argv) < 2:
-        sys.stderr.write('Usage: imslp_enrich.py <permalink|slug|pageid>\n')
-        sys.exit(1)
-    target = sys.argv[1]
+def load_page(title, missing=False):
+    site = get_site()
+    page = site.pages[title]
+    # Retry only while the page may just be lagging; a clean "missing" from the
+    # canonical lookup will not change by waiting.
+    delay = 0.5
+    for _ in range(3):
+        if page.exists or missing:
+            break
+        time.sleep(delay)
+        delay *= 2
+        page = site.pages[title]
+    return page
+
+
+def emit_json(obj):
+    # orjson encodes straight to UTF-8 bytes; stdlib json streams into stdout
+    # without building the whole document as one intermediate string.
+    if orjson is not None:
+        sys.stdout.buffer.write(orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE))
+    else:
+        json.dump(obj, sys.stdout)
+        sys.stdout.write('\n')
+
+
+def enrich(target: str) -> dict:
+    """Collect IMSLP metadata for one permalink, slug or pageid.
+
+    Uses the module-level SESSION and mwclient Site, so repeated calls in one
+    process share connections and the siteinfo probe.
+    """
     resolved = resolve_canonical_page(target) or {}
-    title = resolved.get('title') or extract_title(target)
+    missing = bool(resolved.get('missing'))
+    if resolved.get('title'):
+        title, url_segment = resolved['title'], None
+    elif missing and target.isdigit():
+        # The API already said no such pageid; skip extract_title's lookups.
+        title, url_segment = urllib.parse.unquote(target), None
+    else:
+        title, url_segment = extract_title(target)
     resolved_page_id = resolved.get('page_id')
     resolved_url = resolved.get('url')
 
-    client = ImslpClient()
-    page = client._site.pages[title]
-    attempts = 0
-    while attempts < 3 and not page.exists:
-        time.sleep(2)
-        page = client._site.pages[title]
-        attempts += 1
+    # The mwclient page lookup and the bundle query are independent; run them
+    # side by side over the pooled session.
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        page_future = ex.submit(load_page, title, missing)
+        bundle_future = None if missing else ex.submit(fetch_page_bundle, title, resolved_page_id)
+        page = page_future.result()
+        bundle, bundle_error = {}, None
+        if bundle_future is not None:
+            try:
+                bundle = bundle_future.result()
+            except Exception as e:
+                bundle_error = str(e)
     try:
         mwclient_page_id = getattr(page, 'pageid', None)
     except Exception:
@@ -206,7 +308,7 @@ def main():
 
     metadata = {
         'page_title': title,
-        'url': resolved_url or f"https://imslp.org/wiki/{urllib.parse.quote(title)}",
+        'url': resolved_url or f"https://imslp.org/wiki/{url_segment or urllib.parse.quote(title)}",
         'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
         'exists': bool(page.exists),
         'requested_target': target,
@@ -231,87 +333,56 @@ def main():
     except Exception as e:
         metadata['basic_info_error'] = str(e)
 
+    # Categories, image titles and revisions come from a single query keyed by the
+    # canonical pageid when known, so a mismatched mwclient page cannot leak in.
+    if bundle_error:
+        metadata['bundle_error'] = bundle_error
+
+    metadata['categories'] = [c.get('title') for c in bundle.get('categories') or [] if c.get('title')]
+
     try:
-        metadata['categories'] = [cat.name for cat in list(page.categories())]
+        titles = [img.get('title') for img in bundle.get('images') or [] if img.get('title')]
+        files = build_files(titles[:100])
+        if files:
+            metadata['files_source'] = 'mediawiki_api_pageid' if resolved_page_id else 'mediawiki_api'
+        elif pageid_mismatch:
+            metadata['files_source'] = 'mediawiki_api_pageid_empty'
+        metadata['files'] = files
     except Exception as e:
-        metadata['categories_error'] = str(e)
+        metadata['files_error'] = str(e)
 
-    try:
-        imgs = []
-        if not pageid_mismatch:
-            try:
-                imgs = list(page.images())[:100]
-            except Exception:
-                imgs = []
-
-        # Build initial file list from mwclient if available
-        temp_files = []
-        titles = []
-        for img in imgs:
-            info = getattr(img, 'imageinfo', {})
-            url = info.get('url') if isinstance(info, dict) else None
-            title = getattr(img, 'page_title', None)
-            name = getattr(img, 'name', None)
-            use_title = name or title
-            if use_title:
-                titles.append(use_title)
-            temp_files.append(build_file_entry(use_title, info, name=name))
-
-        # Fallback: fetch imageinfo for titles via MediaWiki API to get direct URLs
+    for rev in (bundle.get('revisions') or [])[:5]:
+        metadata['revision_history'].append({
+            'revid': rev.get('revid'),
+            'user': rev.get('user'),
+            'timestamp': rev.get('timestamp'),
+            'comment': rev.get('comment')
+        })
+
+    return metadata
+
+
+def enrich_many(targets, max_workers=4):
+    def run(target):
         try:
-            if titles:
-                by_title = fetch_imageinfo_by_titles(titles)
-
-                # Merge API info into temp_files
-                for f in temp_files:
-                    ti = f.get('title')
-                    info = by_title.get(ti)
-                    if not info:
-                        continue
-                    url = info.get('url')
-                    f['url'] = url or f.get('url')
-                    f['size'] = info.get('size') if info.get('size') is not None else f.get('size')
-                    f['sha1'] = info.get('sha1') or f.get('sha1')
-                    f['mime_type'] = info.get('mime') or f.get('mime_type')
-                    f['timestamp'] = info.get('timestamp') or f.get('timestamp')
-                    f['user'] = info.get('user') or f.get('user')
-                    f['download_urls'] = {
-                        'original': url,
-                        'https': (url.replace('http:', 'https:') if url else None),
-                        'direct': url
-                    }
-        except Exception:
-            pass
+            return enrich(target)
+        except Exception as e:
+            return {'requested_target': target, 'error': str(e)}
 
-        # If MWClient landed on the wrong page variant (or returned no images), fetch files via canonical pageid.
-        if (pageid_mismatch or not temp_files) and (resolved_page_id or mwclient_page_id):
-            api_page_id = resolved_page_id or mwclient_page_id
-            api_files = fetch_files_via_pageid(api_page_id)
-            if api_files:
-                temp_files = api_files
-                metadata['files_source'] = 'mediawiki_api_pageid'
-            elif pageid_mismatch:
-                metadata['files_source'] = 'mediawiki_api_pageid_empty'
-        elif temp_files:
-            metadata['files_source'] = 'mwclient'
-
-        metadata['files'] = temp_files
-    except Exception as e:
-        metadata['files_error'] = str(e)
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        return list(ex.map(run, targets))
 
-    try:
-        revs = list(page.revisions())
-        for rev in revs[:5]:
-            metadata['revision_history'].append({
-                'revid': rev.get('revid'),
-                'user': rev.get('user'),
-                'timestamp': rev.get('timestamp'),
-                'comment': rev.get('comment')
-            })
-    except Exception as e:
-        metadata['revision_history_error'] = str(e)
 
-    print(json.dumps(metadata))
+def main():
+    if len(sys.argv) < 2 or (sys.argv[1] == '--batch' and len(sys.argv) < 3):
+        sys.stderr.write('Usage: imslp_enrich.py <permalink|slug|pageid> | --batch <targets-file>\n')
+        sys.exit(1)
+    if sys.argv[1] == '--batch':
+        with open(sys.argv[2], encoding='utf-8') as f:
+            targets = [line.strip() for line in f if line.strip()]
+        emit_json(enrich_many(targets))
+        return
+    emit_json(enrich(sys.argv[1]))
 
 
 if __name__ == '__main__':